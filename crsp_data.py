@@ -0,0 +1,255 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from pandas.tseries.offsets import *
+from progress import say
+
+#######################################################################################################################
+#                                               CRSP daily data access                                                #
+#######################################################################################################################
+# get_crsp.py pulls the superset of the daily columns into crsp_dsf_1959.feather. The daily scripts read only the
+# columns they need from that file (memory-mapped), and fall back to WRDS only when the file is missing.
+# The month end and day labels of every row are kept in crsp_dsf_1959_index.feather next to it, in the same row order.
+# crsp_dsf_1959_csr holds the same columns grouped by permno: offsets.npy (permno, start, end) and one .npy per column,
+# sorted by permno and date and memory-mapped, so a script opens only its columns and needs no sort.
+
+crsp_file = 'crsp_dsf_1959.feather'
+index_file = 'crsp_dsf_1959_index.feather'
+csr_dir = 'crsp_dsf_1959_csr'
+
+# monthend: end of the month of the date
+# sig: 1 on the closest trading day to the month end of the firm, 0 otherwise
+# month_count: number of month ends of the firm before this month
+# day_count: number of days of the firm before this day
+index_fields = ['monthend', 'sig', 'month_count', 'day_count']
+
+# name in the scripts: (column in crsp_dsf_1959.feather, select expression in WRDS)
+crsp_fields = {
+    'permno': ('permno', 'a.permno'),
+    'date': ('dlycaldt', 'a.dlycaldt'),
+    'ret': ('dlyret', 'a.dlyret'),
+    'retx': ('dlyretx', 'a.dlyretx'),
+    'exret': ('exret', '(a.dlyret - b.rf) as exret'),
+    'rf': ('rf', 'b.rf'),
+    'mktrf': ('mktrf', 'b.mktrf'),
+    'smb': ('smb', 'b.smb'),
+    'hml': ('hml', 'b.hml'),
+    'vol': ('dlyvol', 'a.dlyvol'),
+    'prc': ('dlyprc', 'a.dlyprc'),
+    'shrout': ('shrout', 'a.shrout'),
+    'bidlo': ('dlylow', 'a.dlylow'),
+    'askhi': ('dlyhigh', 'a.dlyhigh'),
+    'dlydelflg': ('dlydelflg', 'a.dlydelflg'),
+}
+
+
+def crsp_sql(columns, begdate='01/01/1959'):
+    """
+
+    :param columns: names in the scripts, keys of crsp_fields
+    :param begdate: first date
+    :return: query of crsp.dsf_v2 joined with ff.factors_daily
+    """
+    select = ', '.join(crsp_fields[c][1] for c in columns)
+    return f"""
+            select {select}
+            from crsp.dsf_v2 as a
+            left join ff.factors_daily as b
+            on a.dlycaldt=b.date
+            where a.dlycaldt >= '{begdate}'
+            """
+
+
+def missing_fields(path=crsp_file, columns=None):
+    """
+
+    :param path: local file written by get_crsp.py
+    :param columns: names in the scripts, all the keys of crsp_fields by default
+    :return: the names whose column is not in path, e.g. rf and dlydelflg in a file of an older get_crsp.py; all of
+             them if path is missing
+    """
+    columns = list(crsp_fields) if columns is None else columns
+    if not os.path.exists(path):
+        return list(columns)
+    names = pa.ipc.open_file(path).schema.names
+    return [c for c in columns if crsp_fields[c][0] not in names]
+
+
+def build_index(crsp):
+    """
+
+    :param crsp: dataframe with permno and date, in any order
+    :return: dataframe of index_fields in the row order of crsp
+    """
+    df = crsp[['permno', 'date']].sort_values(by=['permno', 'date'], kind='stable')
+    monthend = df['date'] + MonthEnd(0)
+    # the closest trading day to the month end is the last date of the firm in the month
+    sig = (df['date'] == df.groupby([df['permno'], monthend])['date'].transform('max')).astype(np.int8)
+    index = pd.DataFrame({'monthend': monthend, 'sig': sig,
+                          'month_count': sig.groupby(df['permno']).cumsum() - sig,
+                          'day_count': df.groupby('permno').cumcount()}, index=df.index)
+    return index.reindex(crsp.index)
+
+
+def write_index(path=crsp_file, index_path=index_file):
+    """
+
+    :param path: local file written by get_crsp.py
+    :param index_path: index file, row by row with path
+    """
+    raw = [crsp_fields[c][0] for c in ['permno', 'date']]
+    crsp = feather.read_table(path, columns=raw, memory_map=True).to_pandas()
+    crsp.columns = ['permno', 'date']
+    crsp['date'] = pd.to_datetime(crsp['date'])
+    index = build_index(crsp).reset_index(drop=True)
+    with open(index_path, 'wb') as f:
+        feather.write_feather(index, f, compression='uncompressed')
+
+
+def load_index(crsp, columns, path=crsp_file, index_path=index_file):
+    """
+
+    :param crsp: dataframe read from path, or WRDS, with permno and date
+    :param columns: index_fields we need
+    :param path: local file written by get_crsp.py
+    :param index_path: index file, row by row with path
+    :return: dataframe of columns aligned with crsp
+    """
+    if os.path.exists(path) and os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        index = feather.read_table(index_path, columns=list(columns), memory_map=True).to_pandas()
+        if len(index) == len(crsp):
+            say('reading %s from %s' % (list(columns), index_path))
+            index.index = crsp.index
+            return index
+    say('%s not found or out of date, computing %s' % (index_path, list(columns)))
+    return build_index(crsp)[list(columns)]
+
+
+def load_crsp(columns, path=crsp_file, begdate='01/01/1959', csr=csr_dir):
+    """
+
+    :param columns: names in the scripts, keys of crsp_fields or index_fields, e.g. ['permno', 'date', 'ret', 'sig']
+    :param path: local file written by get_crsp.py
+    :param begdate: first date, only used when querying WRDS
+    :param csr: CSR layout written by get_crsp.py, read first when it is up to date; None skips it
+    :return: dataframe with the columns renamed to the names in the scripts
+    """
+    if csr is not None and csr_fresh(columns, csr, path):
+        say('reading %s from %s' % (list(columns), csr))
+        return read_csr(columns, csr)
+    index = [c for c in columns if c in index_fields]
+    data = [c for c in columns if c not in index_fields]
+    # the index needs permno and date of every row
+    read = list(dict.fromkeys(data + (['permno', 'date'] if index else [])))
+    if os.path.exists(path):
+        missing = missing_fields(path, read)
+        if missing:
+            raise ValueError('%s has no column for %s, it was written by an older get_crsp.py: rerun get_crsp.py'
+                             % (path, missing))
+        say('reading %s from %s' % (read, path))
+        raw = [crsp_fields[c][0] for c in read]
+        # only the projected columns are read; memory_map avoids copying them when the file is uncompressed
+        crsp = feather.read_table(path, columns=raw, memory_map=True).to_pandas()
+        crsp.columns = read
+    else:
+        say('%s not found, querying WRDS' % path)
+        import wrds
+        conn = wrds.Connection()
+        crsp = conn.raw_sql(crsp_sql(read, begdate), date_cols=['dlycaldt'] if 'date' in read else None)
+        crsp = crsp.rename(columns={raw: c for c, (raw, sql) in crsp_fields.items()})
+        crsp = crsp[read]
+    if 'date' in crsp:
+        crsp['date'] = pd.to_datetime(crsp['date'])
+    if index:
+        crsp = pd.concat([crsp, load_index(crsp, index, path)], axis=1)
+    return crsp[list(columns)]
+
+
+def csr_column(value):
+    """
+
+    :param value: Series of the dataframe sorted by permno and date
+    :return: numpy array to save; dates as int32 days since 1970-01-01, text as fixed width with '' for missing
+    """
+    if pd.api.types.is_datetime64_any_dtype(value):
+        return value.to_numpy().astype('datetime64[D]').astype(np.int32)
+    if value.dtype == object or pd.api.types.is_string_dtype(value):
+        return value.astype(object).where(value.notna(), '').to_numpy().astype(str)
+    if pd.api.types.is_integer_dtype(value):
+        return value.to_numpy()
+    return value.to_numpy(dtype=np.float64)
+
+
+def write_csr(path=crsp_file, out=csr_dir):
+    """
+
+    :param path: local file written by get_crsp.py, with its index file
+    :param out: directory of the CSR layout
+    """
+    crsp = load_crsp(list(crsp_fields) + index_fields, path, csr=None)
+    crsp = crsp.sort_values(by=['permno', 'date'], kind='stable').reset_index(drop=True)
+    permno = crsp['permno'].to_numpy()
+    start = np.flatnonzero(np.r_[True, permno[1:] != permno[:-1]]) if len(permno) else np.zeros(0, dtype=np.int64)
+    end = np.r_[start[1:], len(permno)].astype(np.int64)
+    os.makedirs(out, exist_ok=True)
+    for c in crsp.columns:
+        np.save(os.path.join(out, c + '.npy'), csr_column(crsp[c]))
+    # written last, its time stamps the layout
+    np.save(os.path.join(out, 'offsets.npy'), np.column_stack([permno[start], start, end]).astype(np.int64))
+
+
+def csr_fresh(columns, csr=csr_dir, path=crsp_file):
+    """
+
+    :param columns: names in the scripts
+    :param csr: directory of the CSR layout
+    :param path: local file written by get_crsp.py
+    :return: the layout has the columns and is not older than path
+    """
+    offsets = os.path.join(csr, 'offsets.npy')
+    if not os.path.exists(offsets) or not all(os.path.exists(os.path.join(csr, c + '.npy')) for c in columns):
+        return False
+    return not os.path.exists(path) or os.path.getmtime(offsets) >= os.path.getmtime(path)
+
+
+def csr_array(c, csr=csr_dir, rows=slice(None)):
+    """
+
+    :param c: name in the scripts
+    :param csr: directory of the CSR layout
+    :param rows: slice of the rows, e.g. the [start, end) of a firm
+    :return: numpy array of the column, memory-mapped unless it has to be converted
+    """
+    a = np.load(os.path.join(csr, c + '.npy'), mmap_mode='r')[rows]
+    if c in ['date', 'monthend']:
+        return a.astype('datetime64[D]').astype('datetime64[ns]')
+    if a.dtype.kind == 'U':
+        return np.where(a == '', None, a).astype(object)
+    return a
+
+
+def read_csr(columns, csr=csr_dir):
+    """
+
+    :param columns: names in the scripts
+    :param csr: directory of the CSR layout
+    :return: dataframe sorted by permno and date
+    """
+    return pd.DataFrame({c: csr_array(c, csr) for c in columns})
+
+
+def csr_firm(permno, columns, csr=csr_dir):
+    """
+
+    :param permno: permno of a firm
+    :param columns: names in the scripts
+    :param csr: directory of the CSR layout
+    :return: dict of numpy arrays of the history of the firm, empty if it is not in the layout
+    """
+    offsets = np.load(os.path.join(csr, 'offsets.npy'), mmap_mode='r')
+    h = np.searchsorted(offsets[:, 0], permno)
+    if h == len(offsets) or offsets[h, 0] != permno:
+        return {c: csr_array(c, csr, slice(0, 0)) for c in columns}
+    return {c: csr_array(c, csr, slice(offsets[h, 1], offsets[h, 2])) for c in columns}
@@ -0,0 +1,199 @@
+import numpy as np
+from rolling import *
+
+#######################################################################################################################
+#                                              Daily characteristics                                                  #
+#######################################################################################################################
+# Every characteristic is a function of the arrays of one firm, the rolling window and the eligible windows, returning
+# a dict of column name to numpy array over the rows of the firm. The arrays may also be (rows, firms) blocks of a
+# panel, see rolling_panel, so the functions only work along the first axis. They are shared by the *_daily.py scripts
+# and the fused driver fused_daily.py.
+
+
+def beta_mktrf(w, window, rows, backend='stream', calendar=None):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :param backend: rolling regression backend, 'stream' or 'batch'
+    :param calendar: factor sums over the trading calendar, see factor_calendar
+    :return: market beta
+    """
+    ols = rolling_ols(w['exret'], w['mktrf'], window, rows, backend=backend, calendar=calendar)
+    return {'beta_mktrf': ols['beta'][..., 0]}
+
+
+def rvar_capm(w, window, rows, backend='stream', calendar=None):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :param backend: rolling regression backend, 'stream' or 'batch'
+    :param calendar: factor sums over the trading calendar, see factor_calendar
+    :return: variance of residual of the CAPM
+    """
+    ols = rolling_ols(w['exret'], w['mktrf'], window, rows, backend=backend, calendar=calendar)
+    return {'rvar': ols['rvar']}
+
+
+def rvar_ff3(w, window, rows, backend='stream', calendar=None):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :param backend: rolling regression backend, 'stream' or 'batch'
+    :param calendar: factor sums over the trading calendar, see factor_calendar
+    :return: variance of residual of the Fama-French three factor model
+    """
+    X = np.stack([w['mktrf'], w['smb'], w['hml']], axis=-1)
+    ols = rolling_ols(w['exret'], X, window, rows, backend=backend, calendar=calendar)
+    return {'rvar': ols['rvar']}
+
+
+def rvar_mean(w, window, rows):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :return: variance of return
+    """
+    return {'rvar': rolling_moments(w['ret'], window)['var']}
+
+
+def maxret(w, window, rows):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :return: maximum daily return
+    """
+    ret_max, ret_min = rolling_extrema(w['ret'], window)
+    return {'maxret': ret_max}
+
+
+def mom(w, window, rows, skip=0, compound=False):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :param skip: the most recent days left out of the window
+    :param compound: False sums daily returns, True compounds them
+    :return: momentum
+    """
+    return {'mom': rolling_momentum(w['ret'], window, skip=skip, compound=compound)}
+
+
+def ill(w, window, rows):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :return: illiquidity
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ill_daily = np.abs(w['ret']) / np.abs(w['prc']) * w['vol']
+    return {'ill': rolling_moments(ill_daily, window)['mean']}
+
+
+def std_dolvol(w, window, rows):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :return: standard deviation of log dollar volume
+    """
+    with np.errstate(divide='ignore'):
+        dolvol = np.log(np.abs(w['vol'] * w['prc']))
+    # inf is treated as missing
+    return {'std_dolvol': rolling_moments(dolvol, window, inf_as_nan=True)['std']}
+
+
+def std_turn(w, window, rows):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :return: standard deviation of share turnover
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        turn = w['vol'] / w['shrout']
+    return {'std_turn': rolling_moments(turn, window)['std']}
+
+
+def baspread(w, window, rows):
+    """
+
+    :param w: dict of numpy arrays of one firm
+    :param window: rolling window
+    :param rows: eligible windows
+    :return: high-low spread of the day scaled by the average midpoint of the window
+    """
+    mid = rolling_moments((w['askhi'] + w['bidlo']) / 2, window)['mean']
+    return {'baspread': (w['askhi'] - w['bidlo']) / mid}
+
+
+# required: columns the script of this characteristic drops missing values on, which gives its sample
+# window rules: a window is eligible when it has min_obs rows, every count_col has min_count (min_obs by default)
+# non-missing values and no nan_col is missing; count_col and nan_col take a column, a list of columns or None
+# skip: the most recent rows left out of every window (momentum skipping the last month), the window rules count the
+# other rows only and func gets skip
+# windows: a list of (window, min_obs) instead of window and min_obs computes every horizon in one pass, written as
+# e.g. rvar_ff3_20d and rvar_ff3_60d to the same file
+# calendar: factors in the order of the regressors; their window sums are computed once over the trading calendar and
+# shared by every firm without missing days, the other firms sum them by themselves
+# columns: output of func: column written to file, the same as the *_daily.py scripts
+chars_daily = {
+    'beta': {'func': beta_mktrf, 'cols': ['mktrf', 'exret'], 'window': 60, 'min_obs': 60,
+             'count_col': 'vol', 'nan_col': 'exret', 'columns': {'beta_mktrf': 'beta_mktrf'},
+             'required': ['ret', 'vol', 'dlydelflg', 'exret', 'rf', 'mktrf', 'smb', 'hml'], 'calendar': ['mktrf'],
+             'file': 'beta_daily.feather'},
+    'rvar_capm': {'func': rvar_capm, 'cols': ['mktrf', 'exret'], 'window': 60, 'min_obs': 60,
+                  'count_col': 'vol', 'nan_col': 'exret', 'columns': {'rvar': 'rvar_capm'},
+                  'required': ['ret', 'vol', 'exret', 'mktrf'], 'calendar': ['mktrf'],
+                  'file': 'rvar_capm_daily.feather'},
+    'rvar_ff3': {'func': rvar_ff3, 'cols': ['mktrf', 'smb', 'hml', 'exret'], 'window': 60, 'min_obs': 60,
+                 'count_col': 'vol', 'nan_col': 'exret', 'columns': {'rvar': 'rvar_ff3'},
+                 'required': ['ret', 'vol', 'exret', 'mktrf', 'smb', 'hml'], 'calendar': ['mktrf', 'smb', 'hml'],
+                 'file': 'rvar_ff3_daily.feather'},
+    'rvar_mean': {'func': rvar_mean, 'cols': ['ret'], 'window': 60, 'min_obs': 60,
+                  'count_col': 'vol', 'nan_col': 'exret', 'columns': {'rvar': 'rvar_mean'},
+                  'required': ['ret', 'vol', 'exret', 'mktrf', 'smb', 'hml'],
+                  'file': 'rvar_mean_daily.feather'},
+    'mom1m': {'func': mom, 'cols': ['ret'], 'window': 20, 'min_obs': 15,
+              'count_col': 'vol', 'nan_col': 'exret', 'columns': {'mom': 'mom1m'},
+              'required': ['ret', 'vol', 'exret'],
+              'file': 'mom1m_daily.feather'},
+    'mom12m': {'func': mom, 'cols': ['ret'], 'window': 250, 'min_obs': 15,
+               'count_col': 'vol', 'nan_col': 'exret', 'columns': {'mom': 'mom12m'},
+               'required': ['ret', 'vol', 'exret'],
+               'file': 'mom12m_daily.feather'},
+    'ill': {'func': ill, 'cols': ['vol', 'prc', 'ret'], 'window': 60, 'min_obs': 60,
+            'count_col': 'vol', 'nan_col': 'exret', 'columns': {'ill': 'ill'},
+            'required': ['ret', 'vol', 'prc', 'exret'],
+            'file': 'ill_daily.feather'},
+    'std_dolvol': {'func': std_dolvol, 'cols': ['vol', 'prc'], 'window': 60, 'min_obs': 60,
+                   'count_col': 'vol', 'nan_col': 'prc', 'columns': {'std_dolvol': 'std_dolvol'},
+                   'required': ['vol', 'prc'],
+                   'file': 'std_dolvol_daily.feather'},
+    'std_turn': {'func': std_turn, 'cols': ['vol', 'shrout'], 'window': 60, 'min_obs': 60,
+                 'count_col': 'vol', 'nan_col': 'shrout', 'columns': {'std_turn': 'std_turn'},
+                 'required': ['vol', 'shrout'],
+                 'file': 'std_turn_daily.feather'},
+    'baspread': {'func': baspread, 'cols': ['askhi', 'bidlo'], 'window': 60, 'min_obs': 60,
+                 'count_col': 'vol', 'nan_col': 'exret', 'columns': {'baspread': 'baspread'},
+                 'required': ['ret', 'exret', 'askhi', 'bidlo', 'vol', 'dlydelflg'],
+                 'file': 'baspread_daily.feather'},
+    'maxret': {'func': maxret, 'cols': ['ret'], 'window': 60, 'min_obs': 60,
+               'count_col': 'vol', 'nan_col': 'exret', 'columns': {'maxret': 'maxret'},
+               'required': ['ret', 'vol', 'exret'],
+               'file': 'maxret_daily.feather'},
+}
@@ -0,0 +1,102 @@
+import pandas as pd
+from daily_chars import *
+from crsp_data import *
+from incremental import *
+
+# Driver of the *_daily.py scripts and fused_daily.py: a script sets its knobs and its specs, and main loads the CRSP
+# columns the specs require, walks the firms once and writes every characteristic to its spec['file'].
+# importing this module loads no data: load_data, preprocess, compute and write can be driven from Python, and the
+# workers of the pool start without reading crsp_dsf_1959.feather again.
+
+
+def load_data(specs):
+    """
+    :param specs: list of characteristic specs
+    :return: stock dataframe with the columns the characteristics require
+    """
+    # CRSP Block: read from crsp_dsf_1959.feather of get_crsp.py, or WRDS if the file is missing
+    columns = ['permno', 'date'] + [c for spec in specs for c in spec['required']]
+    crsp = load_crsp(list(dict.fromkeys(columns)))
+    return crsp
+
+
+def preprocess(crsp, specs, since=None):
+    """
+    :param crsp: stock dataframe of load_data
+    :param specs: list of characteristic specs
+    :param since: result of parse_since, None for a full rebuild
+    :return: stock dataframe sorted by permno and date and list of the cutoffs of the characteristics
+    """
+    crsp = crsp.dropna(subset=['permno', 'date'])
+
+    # every characteristic keeps the rows where its own required columns are not missing, which is the dropna of its
+    # own script; the rows no characteristic keeps are dropped here
+    keep = pd.concat([crsp[spec['required']].notna().all(axis=1) for spec in specs], axis=1)
+    crsp = crsp[keep.any(axis=1)]
+
+    # sort variables by permno and date
+    crsp = sort_firms(crsp)
+
+    # change variable format to int
+    crsp['permno'] = crsp['permno'].astype(int)
+
+    # Line up date to be end of month
+    crsp['date'] = pd.to_datetime(crsp['date'])
+
+    # incremental update: python beta_daily.py --since last (or a date) computes only the new days, see incremental.py
+    # lookback is the longest window of the specs - 1, every horizon of windows included, counted on the rows each
+    # characteristic keeps
+    cutoffs = [output_cutoff(since, spec['file'], list(spec['columns'].values())[0]) for spec in specs]
+    masks = [crsp[spec['required']].notna().all(axis=1) for spec in specs]
+    lookback = max(window for spec in specs for window, min_obs, suffix in spec_windows(spec)) - 1
+    crsp = trim_history(crsp, cutoffs, lookback=lookback, masks=masks)
+
+    return crsp, cutoffs
+
+
+def compute(crsp, specs, engine='firm', checkpoint=None, chunks=20):
+    """
+    :param crsp: stock dataframe of preprocess
+    :param specs: list of characteristic specs
+    :param engine: 'firm' for rolling_pool, 'panel' for rolling_panel
+    :param checkpoint: checkpoint directory of rolling_pool, None keeps the results in memory only
+    :param chunks: chunks of firms of rolling_pool, up to one core each
+    :return: a dataframe with the characteristics
+    """
+    if engine == 'panel':
+        return rolling_panel(crsp, specs)
+    # the columns are shared with the workers once, every worker gets the offsets of a balanced chunk of firms
+    return rolling_pool(crsp, specs, chunks, checkpoint)
+
+
+def write(crsp_out, specs, cutoffs, checkpoint=None):
+    """
+    :param crsp_out: dataframe of compute
+    :param specs: list of characteristic specs
+    :param cutoffs: cutoffs of preprocess, None writes the full history
+    :param checkpoint: checkpoint directory of compute, removed once every file is written
+    """
+    # process dataframe: one file per characteristic
+    for spec, cutoff in zip(specs, cutoffs):
+        columns = spec_columns([spec])
+        char_out = crsp_out.dropna(subset=columns, how='all')  # drop NA due to rolling
+        char_out = char_out.reset_index(drop=True)
+        char_out = char_out[['permno', 'date'] + columns]
+
+        write_output(char_out, spec['file'], cutoff)
+    clear_checkpoint(checkpoint)
+
+
+def main(specs, engine='firm', checkpoint=None, chunks=20, since=None):
+    """
+    :param specs: list of characteristic specs
+    :param engine: 'firm' or 'panel', see compute
+    :param checkpoint: checkpoint directory of the 'firm' engine
+    :param chunks: chunks of firms of the 'firm' engine, up to one core each
+    :param since: result of parse_since, None for a full rebuild
+    :return: a dataframe with the characteristics
+    """
+    crsp, cutoffs = preprocess(load_data(specs), specs, since)
+    crsp_out = compute(crsp, specs, engine, checkpoint, chunks)
+    write(crsp_out, specs, cutoffs, checkpoint)
+    return crsp_out
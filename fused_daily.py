@@ -0,0 +1,33 @@
+from daily_driver import *
+
+# Fused driver: load the daily panel once, walk each permno's history once and write every characteristic to the same
+# feather file as its own *_daily.py script, e.g. beta_daily.feather, which merge_chars_daily.py reads.
+
+#######################
+# Calculate the chars #
+#######################
+
+# output frequency: 'daily', 'week', 'month' or a list of dates; each characteristic is only computed on the last day of
+# the firm in the week or month among the rows it keeps (or on the dates), its window still covers every day before them
+freq = 'daily'
+
+# engine: 'firm' walks the firms on a pool of workers, 'panel' rolls blocks of firms of about the same length at once
+# on a dense rows x firms panel in one process, which is faster than the 'firm' engine on one core
+engine = 'firm'
+
+# checkpoint: with the 'firm' engine every finished chunk of firms is saved in this directory, and a run that died
+# (out of memory, preempted) starts again from the chunks done; it is removed once the output is written. None keeps
+# the results in memory only
+checkpoint = 'fused_daily_checkpoint'
+
+# if you want to change the rolling window of a characteristic, please change window and min_obs in chars_daily
+specs = [dict(spec, freq=freq) for spec in chars_daily.values()]
+
+# chunks: please split the firms according to your CPU situation. For example, 20 chunks use up to 20 cores; more chunks
+# than cores, e.g. 100, let idle cores pick up the remaining work
+chunks = 20
+
+
+if __name__ == '__main__':
+    set_progress(parse_progress())
+    main(specs, engine, checkpoint, chunks, since=parse_since())
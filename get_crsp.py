@@ -6,23 +6,24 @@ from dateutil.relativedelta import *
 from pandas.tseries.offsets import *
 import datetime
 import pyarrow.feather as feather
+from crsp_data import *
 
 ###################
 # Connect to WRDS #
 ###################
 conn = wrds.Connection()
 
-# CRSP Block
-crsp = conn.raw_sql("""
-                      select a.permno, a.dlycaldt, a.dlyret, a.dlyretx, (a.dlyret - b.rf) as exret, b.mktrf, b.smb, b.hml, a.dlyvol, a.dlyprc, 
-                             a.shrout, a.dlylow, a.dlyhigh
-                      from crsp.dsf_v2 as a
-                      left join ff.factors_daily as b
-                      on a.dlycaldt=b.date
-                      where a.dlycaldt >= '01/01/1959'
-                      """, date_cols=['dlycaldt'])
+# CRSP Block: the superset of the columns of the daily scripts, see crsp_fields in crsp_data.py
+crsp = conn.raw_sql(crsp_sql(list(crsp_fields)), date_cols=['dlycaldt'])
 
 # crsp = crsp.dropna()
 
-with open('crsp_dsf_1959.feather', 'wb') as f:
-    feather.write_feather(crsp, f)
+# uncompressed, so that the daily scripts can memory-map the columns they need
+with open(crsp_file, 'wb') as f:
+    feather.write_feather(crsp, f, compression='uncompressed')
+
+# month end and day labels of every row, memory-mapped by the daily scripts, see index_fields in crsp_data.py
+write_index()
+
+# the same columns grouped by permno, see csr_dir in crsp_data.py
+write_csr()
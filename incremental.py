@@ -0,0 +1,106 @@
+import os
+import argparse
+import pandas as pd
+import pyarrow.feather as feather
+from progress import say
+
+#######################################################################################################################
+#                                              Incremental daily update                                               #
+#######################################################################################################################
+# python beta_daily.py --since last        only the days after the last date of every permno in beta_daily.feather
+# python beta_daily.py --since 2024-01-02  the days from 2024-01-02 on, replacing what the output has after that date
+# Only the trailing window before the first new day of every permno is kept, the new days are computed and appended.
+
+
+def parse_since(argv=None):
+    """
+
+    :param argv: command line arguments, sys.argv[1:] by default
+    :return: None for a full rebuild, 'last', or the first date to recompute as a Timestamp
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--since', default=None,
+                        help="'last' to continue from the existing output, or the first date to recompute")
+    args, unknown = parser.parse_known_args(argv)
+    if args.since is None or args.since == 'last':
+        return args.since
+    return pd.Timestamp(args.since)
+
+
+def output_cutoff(since, file, column):
+    """
+
+    :param since: result of parse_since
+    :param file: existing output, e.g. beta_daily.feather
+    :param column: characteristic column in the output, or the name of its horizons
+    :return: None for a full rebuild, a Timestamp or a Series of dates by permno; days after the cutoff are computed
+    """
+    if since is None:
+        return None
+    if not os.path.exists(file):
+        say('%s not found, computing the full history' % file)
+        return None
+    if since == 'last':
+        with open(file, 'rb') as f:
+            out = feather.read_feather(f)
+        # the characteristic, or its horizons such as rvar_ff3_20d and rvar_ff3_60d
+        columns = [c for c in out.columns if c == column or (c.startswith(column + '_') and c.endswith('d'))]
+        out = out.dropna(subset=columns, how='all')
+        return out.groupby('permno')['date'].max()
+    return since - pd.Timedelta(days=1)
+
+
+def is_new(df, cutoff):
+    """
+
+    :param df: dataframe with permno and date
+    :param cutoff: result of output_cutoff
+    :return: boolean Series, the day is after the cutoff (every day of a permno missing from the output)
+    """
+    if cutoff is None:
+        return pd.Series(True, index=df.index)
+    if isinstance(cutoff, pd.Series):
+        cutoff = df['permno'].map(cutoff)
+    return ~(df['date'] <= cutoff)
+
+
+def trim_history(crsp, cutoff, lookback, masks=None):
+    """
+
+    :param crsp: stock dataframe sorted by permno and date
+    :param cutoff: result of output_cutoff, or a list of them (the earliest wins)
+    :param lookback: days of history before the first new day, e.g. 249 for a 250 days window
+    :param masks: list of boolean Series, rows each characteristic keeps; lookback counts these rows only
+    :return: the new days of every permno and the lookback days before them
+    """
+    cutoffs = cutoff if isinstance(cutoff, list) else [cutoff]
+    if any(c is None for c in cutoffs):
+        return crsp
+    new = pd.Series(False, index=crsp.index)
+    for c in cutoffs:
+        new = new | is_new(crsp, c)
+    keep = new.copy()
+    for m in masks or [pd.Series(True, index=crsp.index)]:
+        m = m.astype(int)
+        before = m.groupby(crsp['permno']).cumsum() - m  # rows kept by this mask before this day
+        first = before.where(new).groupby(crsp['permno']).transform('min')
+        keep = keep | (before >= first - lookback)
+    say('incremental update: %s of %s rows' % (keep.sum(), len(crsp)))
+    return crsp[keep]
+
+
+def write_output(out, file, cutoff):
+    """
+
+    :param out: dataframe with permno, date and the characteristic
+    :param file: output, e.g. beta_daily.feather
+    :param cutoff: result of output_cutoff, None writes out as it is
+    """
+    if cutoff is not None:
+        out = out[is_new(out, cutoff)]
+        with open(file, 'rb') as f:
+            old = feather.read_feather(f)
+        old = old[~is_new(old, cutoff)]
+        out = pd.concat([old, out]).sort_values(by=['permno', 'date']).reset_index(drop=True)
+    with open(file, 'wb') as f:
+        feather.write_feather(out, f)
@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import argparse
+import importlib
+import subprocess
+import multiprocessing as mp
+from crsp_data import crsp_file, index_file, crsp_fields, crsp_sql, missing_fields
+
+#######################################################################################################################
+#                                                   Pipeline runner                                                   #
+#######################################################################################################################
+# get_crsp.py -> the eleven *_daily.py scripts -> merge_chars_daily.py -> impute_rank_output_daily.py
+#                accounting_hxz_daily.py -------^ (WRDS, independent of get_crsp.py)
+# The stages are linked by the files they read and write: a stage depends on every stage writing one of its inputs.
+# Independent stages run at the same time as subprocesses within a budget of cores, a stage is skipped when the
+# fingerprint of its inputs matches the manifest of its outputs, and the critical path of the run is reported at the
+# end.
+#
+# Every output gets a sidecar manifest, e.g. beta_daily.feather.manifest.json, with the fingerprint of the stage that
+# wrote it and the sha256 of the output itself. The fingerprint covers the content of the input files (the sha256 in
+# their own manifest), the code of the script and the modules it imports, and the parameters of the stage: the SQL of
+# get_crsp.py, and the spec of a daily script (window, min_obs, windows, kwargs, ...). The kernels of daily_chars.py
+# count as code, chars_daily does not, so changing the window of one characteristic reruns only that characteristic,
+# and merge and impute_rank only if its output changed.
+#
+# python pipeline.py                         run what is out of date on all the cores
+# python pipeline.py --cores 8 --force crsp  pull CRSP again and rerun everything downstream of it on 8 cores
+# python pipeline.py --since last            passed on to the daily scripts, see incremental.py
+# The data files are read and written in the working directory, like the scripts do; the scripts and modules are next
+# to this file.
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+
+# modules of the daily scripts, a change to them reruns the scripts; daily_chars.py is in daily_params
+daily_modules = ['daily_driver.py', 'rolling.py', 'crsp_data.py', 'incremental.py']
+
+
+def crsp_params():
+    """
+
+    :return: parameters of get_crsp.py: the query of crsp.dsf_v2, with its first date
+    """
+    return {'sql': crsp_sql(list(crsp_fields))}
+
+
+def daily_params(script):
+    """
+
+    :param script: a daily script, e.g. beta_daily.py
+    :return: parameters of the script: its spec, and the code of the kernels of daily_chars.py
+    """
+    module = importlib.import_module(os.path.splitext(script)[0])
+    kernels = inspect.getmembers(sys.modules['daily_chars'], inspect.isfunction)
+    return {'spec': json.dumps(module.spec, sort_keys=True, default=lambda v: getattr(v, '__name__', repr(v))),
+            'kernels': {name: inspect.getsource(func) for name, func in kernels if func.__module__ == 'daily_chars'}}
+
+
+# name: script, inputs, outputs, parallel (the script runs a pool of workers on the cores it is given, the others use
+# one core), params (function returning the parameters of the stage that are not in its files), source (the stage
+# pulls from WRDS, its outputs written before the manifests are taken as they are instead of pulled again), check
+# (function telling whether the outputs on disk can be used at all, a stage failing it runs whatever its manifests say);
+# the parallel scripts set spec, engine and checkpoint for main of daily_driver.py, which is called with one chunk of
+# firms per core; the others run as they are
+daily_stages = {
+    'beta': ('beta_daily.py', 'beta_daily.feather'),
+    'rvar_capm': ('rvar_capm_daily.py', 'rvar_capm_daily.feather'),
+    'rvar_ff3': ('rvar_ff3_daily.py', 'rvar_ff3_daily.feather'),
+    'rvar_mean': ('rvar_mean_daily.py', 'rvar_mean_daily.feather'),
+    'baspread': ('bid_ask_spread_daily.py', 'baspread_daily.feather'),
+    'maxret': ('maxret_daily.py', 'maxret_daily.feather'),
+    'std_dolvol': ('std_dolvol_daily.py', 'std_dolvol_daily.feather'),
+    'ill': ('ill_daily.py', 'ill_daily.feather'),
+    'std_turn': ('std_turn_daily.py', 'std_turn_daily.feather'),
+    'mom1m': ('mom1m_daily.py', 'mom1m_daily.feather'),
+    'mom12m': ('mom12m_daily.py', 'mom12m_daily.feather'),
+}
+
+stages = {
+    'crsp': dict(script='get_crsp.py', inputs=['crsp_data.py'], parallel=False,
+                 outputs=[crsp_file, index_file], params=crsp_params, source=True,
+                 check=lambda: not missing_fields()),
+    **{name: dict(script=script, inputs=[crsp_file, index_file] + daily_modules, parallel=True, outputs=[file],
+                  params=lambda script=script: daily_params(script))
+       for name, (script, file) in daily_stages.items()},
+    'accounting': dict(script='accounting_hxz_daily.py', inputs=['functions.py'], parallel=False,
+                       outputs=['chars_a_daily.feather', 'chars_q_daily.feather'], source=True),
+    'merge': dict(script='merge_chars_daily.py', parallel=False,
+                  inputs=['chars_a_daily.feather', 'chars_q_daily.feather'] + [f for s, f in daily_stages.values()],
+                  outputs=['chars_a_raw.feather', 'chars_q_raw.feather']),
+    'impute_rank': dict(script='impute_rank_output_daily.py', inputs=['chars_a_raw.feather', 'chars_q_raw.feather',
+                                                                      'functions.py'], parallel=False,
+                        outputs=['chars_daily_raw_no_impute.feather', 'chars_daily_raw_imputed.feather',
+                                 'chars_daily_rank_no_impute.feather', 'chars_daily_rank_imputed.feather']),
+}
+
+
+def stage_deps(stages):
+    """
+
+    :param stages: dict of stages, see stages above
+    :return: dict of the names of the stages writing the inputs of every stage
+    """
+    writer = {out: name for name, stage in stages.items() for out in stage['outputs']}
+    return {name: sorted({writer[i] for i in stage['inputs'] if i in writer and writer[i] != name})
+            for name, stage in stages.items()}
+
+
+def topo_order(deps):
+    """
+
+    :param deps: result of stage_deps
+    :return: names of the stages, every stage after the stages it depends on
+    """
+    order, done = [], set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise ValueError('stages depend on each other: %s' % ' -> '.join(path + [name]))
+        for d in deps[name]:
+            visit(d, path + [name])
+        done.add(name)
+        order.append(name)
+
+    for name in deps:
+        visit(name, [])
+    return order
+
+
+def stage_path(file):
+    """
+
+    :param file: script, module or data file of a stage
+    :return: path of the file, scripts and modules next to this file
+    """
+    return os.path.join(code_dir, file) if file.endswith('.py') else file
+
+
+def file_hash(path):
+    """
+
+    :param path: a file
+    :return: sha256 of the content of the file
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(path):
+    """
+
+    :param path: output of a stage
+    :return: the manifest of the output, None if it is missing or the output changed since it was written
+    """
+    if not os.path.exists(path) or not os.path.exists(path + '.manifest.json'):
+        return None
+    with open(path + '.manifest.json') as f:
+        manifest = json.load(f)
+    if manifest.get('size') != os.path.getsize(path) or manifest.get('mtime') != os.path.getmtime(path):
+        return None
+    return manifest
+
+
+def write_manifest(path, stage, fingerprint, parts):
+    """
+
+    :param path: output of a stage
+    :param stage: name of the stage
+    :param fingerprint: result of stage_fingerprint
+    :param parts: what the fingerprint covers, result of stage_fingerprint
+    """
+    manifest = {'stage': stage, 'fingerprint': fingerprint, 'sha256': file_hash(path), 'size': os.path.getsize(path),
+                'mtime': os.path.getmtime(path), 'parts': parts}
+    with open(path + '.manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+# sha256 of the inputs without a manifest by (path, size, mtime), every stage reading them hashes them once
+hash_cache = {}
+
+
+def input_hash(path):
+    """
+
+    :param path: input of a stage
+    :return: sha256 of the input, from its manifest when it has an up to date one; None if it is missing
+    """
+    if not os.path.exists(path):
+        return None
+    manifest = read_manifest(path)
+    if manifest:
+        return manifest['sha256']
+    key = (path, os.path.getsize(path), os.path.getmtime(path))
+    if key not in hash_cache:
+        hash_cache[key] = file_hash(path)
+    return hash_cache[key]
+
+
+def stage_fingerprint(stage):
+    """
+
+    :param stage: a stage, see stages above
+    :return: sha256 of what the outputs of the stage depend on, and the parts it covers
+    """
+    parts = {'code': {f: input_hash(stage_path(f)) for f in [stage['script']] + stage['inputs'] if f.endswith('.py')},
+             'inputs': {f: input_hash(f) for f in stage['inputs'] if not f.endswith('.py')},
+             'params': stage['params']() if 'params' in stage else {}}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest(), parts
+
+
+def is_fresh(stage, fingerprint):
+    """
+
+    :param stage: a stage, see stages above
+    :param fingerprint: result of stage_fingerprint
+    :return: every output exists, unchanged since the stage wrote it with the same fingerprint
+    """
+    manifests = [read_manifest(out) for out in stage['outputs']]
+    return all(m is not None and m['fingerprint'] == fingerprint for m in manifests)
+
+
+def stage_command(stage, cores, since=None, argv=()):
+    """
+
+    :param stage: a stage, see stages above
+    :param cores: cores given to the stage
+    :param since: --since of the daily scripts, 'last' or a date, None for a full rebuild
+    :param argv: extra command line arguments of the daily scripts, e.g. ['--quiet']
+    :return: command running the stage
+    """
+    if not stage['parallel']:
+        return [sys.executable, stage_path(stage['script'])]
+    module = os.path.splitext(stage['script'])[0]
+    # the __main__ of the script: --quiet and --verbose of argv, then one chunk of firms per core
+    code = ('import %s as m; m.set_progress(m.parse_progress()); '
+            'm.main([m.spec], m.engine, m.checkpoint, chunks=%d, since=m.parse_since())' % (module, cores))
+    return [sys.executable, '-c', code] + ([] if since is None else ['--since', since]) + list(argv)
+
+
+def path_lengths(deps, duration):
+    """
+
+    :param deps: result of stage_deps
+    :param duration: dict of the seconds of every stage, estimates before the run or measures after it
+    :return: dict of the longest chain of seconds from every stage to the end of the pipeline, and the next stage on it
+    """
+    users = {name: [n for n in deps if name in deps[n]] for name in deps}
+    length = {}
+    for name in reversed(topo_order(deps)):
+        nxt = max(users[name], key=lambda n: length[n][0], default=None)
+        length[name] = (duration.get(name, 0) + (length[nxt][0] if nxt else 0), nxt)
+    return length
+
+
+def critical_path(deps, finish):
+    """
+
+    :param deps: result of stage_deps
+    :param finish: dict of the seconds from the start of the run when every stage finished
+    :return: the chain of stages that ended last, each one the last of the stages it waited for
+    """
+    if not finish:
+        return []
+    path = [max(finish, key=finish.get)]
+    while [d for d in deps[path[0]] if d in finish]:
+        path.insert(0, max([d for d in deps[path[0]] if d in finish], key=finish.get))
+    return path
+
+
+def run(names=None, cores=None, force=(), since=None, argv=(), log_dir='pipeline_logs', poll=0.2):
+    """
+
+    :param names: stages to run with the stages they depend on, all by default
+    :param cores: core budget shared by the running stages, all the cores by default
+    :param force: stages to run even if they are up to date; the stages depending on them follow as their inputs change
+    :param since: --since of the daily scripts, 'last' or a date, None for a full rebuild
+    :param argv: extra command line arguments of the daily scripts, e.g. ['--quiet']
+    :param log_dir: directory of the output of every stage, <stage>.log
+    :param poll: seconds between checks of the running stages
+    :return: dict of the status of every stage: 'done', 'skipped', 'failed' or 'blocked' (a stage it depends on failed)
+    """
+    unknown = [name for name in list(names or []) + list(force) if name not in stages]
+    if unknown:
+        raise ValueError('unknown stages %s, the stages are %s' % (unknown, list(stages)))
+    cores = cores or mp.cpu_count()
+    deps = stage_deps(stages)
+    wanted = set(names or stages)
+    for name in topo_order(deps)[::-1]:
+        if name in wanted:
+            wanted.update(deps[name])
+    todo = [name for name in topo_order(deps) if name in wanted]
+    os.makedirs(log_dir, exist_ok=True)
+    # the daily scripts are imported from code_dir
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([code_dir, os.environ.get('PYTHONPATH', '')]).rstrip(os.pathsep))
+
+    # ready stages start by the longest chain of stages waiting for them
+    rank = path_lengths(deps, {name: 1 for name in stages})
+    status, running, start, finish, duration, given, fingerprints = {}, {}, {}, {}, {}, {}, {}
+    t0 = time.time()
+    while todo or running:
+        for name, (proc, log) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            log.close()
+            finish[name] = time.time() - t0
+            duration[name] = finish[name] - start[name]
+            status[name] = 'done' if proc.returncode == 0 else 'failed'
+            print('%s %s in %.1fs on %d cores' % (name, status[name], duration[name], given[name]))
+            if status[name] == 'done':
+                for out in [out for out in stages[name]['outputs'] if os.path.exists(out)]:
+                    write_manifest(out, name, *fingerprints[name])
+            del running[name]
+        for name in [n for n in todo if any(status.get(d) in ['failed', 'blocked'] for d in deps[n])]:
+            print('%s blocked, a stage it depends on failed' % name)
+            status[name] = 'blocked'
+            todo.remove(name)
+        ready = sorted([n for n in todo if all(d in status for d in deps[n])], key=lambda n: -rank[n][0])
+        free = cores - sum(given[n] for n in running)
+        for i, name in enumerate(ready):
+            stage = stages[name]
+            # e.g. a crsp_dsf_1959.feather of an older get_crsp.py, without the columns added since, is pulled again
+            usable = stage.get('check', lambda: True)()
+            if name not in fingerprints:
+                fingerprints[name] = stage_fingerprint(stage)
+                if stage.get('source') and name not in force and usable and all(
+                        os.path.exists(out) and not os.path.exists(out + '.manifest.json') for out in stage['outputs']):
+                    for out in stage['outputs']:
+                        write_manifest(out, name, *fingerprints[name])
+            if name not in force and usable and is_fresh(stage, fingerprints[name][0]):
+                print('%s is up to date, skipped' % name)
+                status[name] = 'skipped'
+                start[name] = finish[name] = time.time() - t0
+                duration[name] = 0
+                todo.remove(name)
+                continue
+            # a parallel stage takes its share of the free cores among the ready stages left
+            need = max(1, free // (len(ready) - i)) if stage['parallel'] else 1
+            if need > free:
+                break
+            given[name] = need
+            free -= need
+            log = open(os.path.join(log_dir, name + '.log'), 'w')
+            print('%s started on %d cores' % (name, need))
+            start[name] = time.time() - t0
+            running[name] = (subprocess.Popen(stage_command(stage, need, since, argv), stdout=log,
+                                              stderr=subprocess.STDOUT, env=env), log)
+            todo.remove(name)
+        if running:
+            time.sleep(poll)
+
+    total = time.time() - t0
+    path = critical_path(deps, finish)
+    print('pipeline finished in %.1fs, busy %.1fs' % (total, sum(duration.values())))
+    print('critical path: %s' % ' -> '.join('%s %.1fs' % (n, duration[n]) if status[n] != 'skipped'
+                                              else '%s skipped' % n for n in path))
+    return status
+
+
+def parse_args(argv=None):
+    """
+
+    :param argv: command line arguments, sys.argv[1:] by default
+    :return: arguments of run, and the arguments passed on to the daily scripts
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help='stages to run with the stages they depend on, all by default')
+    parser.add_argument('--cores', type=int, default=None, help='core budget, all the cores by default')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to run even if they are up to date')
+    parser.add_argument('--since', default=None,
+                        help="passed on to the daily scripts: 'last' to continue from their output, or the first date "
+                             "to recompute")
+    return parser.parse_known_args(argv)
+
+
+if __name__ == '__main__':
+    args, unknown = parse_args()
+    status = run(args.names or None, args.cores, args.force, args.since, unknown)
+    sys.exit(1 if any(s in ['failed', 'blocked'] for s in status.values()) else 0)
@@ -0,0 +1,153 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import multiprocessing as mp
+
+#######################################################################################################################
+#                                               Progress and throughput                                               #
+#######################################################################################################################
+# python beta_daily.py            a progress line every few seconds and a JSON summary at the end
+# python beta_daily.py --quiet    the JSON summary only, every other line goes through say, note or tick
+# python beta_daily.py --verbose  also a line for every chunk of firms (or block of firms of the panel)
+# Workers do not print. Every chunk of firms has a row of counters (see fields) in shared memory, which its worker adds
+# to as it goes, and the parent sums the rows for the progress line and the summary.
+
+# firms: firms done, rows: rows of the firms done, windows: windows evaluated (rows x horizons handed to a kernel),
+# min_obs / nan / count / anchor: windows skipped by each rule, in this order (fewer than min_obs rows, a missing value
+# of nan_col, fewer than min_count values of count_col, not an anchor row), values: characteristic values kept,
+# seconds: time spent in the workers
+fields = ['firms', 'rows', 'windows', 'min_obs', 'nan', 'count', 'anchor', 'values', 'seconds']
+field = {name: j for j, name in enumerate(fields)}
+
+# 'quiet', 'normal' or 'verbose', and seconds between two progress lines
+level = 'normal'
+interval = 10
+
+
+def parse_progress(argv=None):
+    """
+
+    :param argv: command line arguments, sys.argv[1:] by default
+    :return: 'quiet', 'normal' or 'verbose'
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quiet', action='store_true', help='print the JSON summary only')
+    parser.add_argument('--verbose', action='store_true', help='print every chunk of firms as it is done')
+    args, unknown = parser.parse_known_args(argv)
+    return 'quiet' if args.quiet else 'verbose' if args.verbose else 'normal'
+
+
+def set_progress(mode, every=None):
+    """
+
+    :param mode: 'quiet', 'normal' or 'verbose'
+    :param every: seconds between two progress lines, unchanged by default
+    """
+    global level, interval
+    level = mode
+    interval = interval if every is None else every
+
+
+def new_counters(n):
+    """
+
+    :param n: number of chunks
+    :return: float64 array (n, len(fields)) of zeros, one row of counters for every chunk
+    """
+    return np.zeros((n, len(fields)), dtype=np.float64)
+
+
+def start_progress(counters, firms, rows):
+    """
+
+    :param counters: result of new_counters, possibly in shared memory
+    :param firms: firms to compute
+    :param rows: rows of these firms
+    :return: state of the progress of a run
+    """
+    now = time.time()
+    return {'counters': counters, 'firms': firms, 'rows': rows, 't0': now, 'last': now}
+
+
+def totals(state):
+    """
+
+    :param state: result of start_progress
+    :return: dict of field to the sum of the counters of all the chunks
+    """
+    return dict(zip(fields, state['counters'].sum(axis=0).tolist()))
+
+
+def tick(state, force=False):
+    """
+    Print the aggregated progress line if interval seconds have passed since the last one.
+
+    :param state: result of start_progress
+    :param force: print it anyway
+    """
+    now = time.time()
+    if level == 'quiet' or (not force and now - state['last'] < interval):
+        return
+    state['last'] = now
+    t, elapsed = totals(state), max(now - state['t0'], 1e-9)
+    done = t['rows'] / state['rows'] if state['rows'] else 1
+    left = '%.0fs left' % (elapsed * (1 - done) / done) if done > 0 else 'time left unknown'
+    print('progress: %d / %d firms, %d / %d rows (%.1f%%), %.0f rows/s, %d windows, skipped min_obs %d nan %d '
+          'count %d anchor %d, %.0fs elapsed, %s' %
+          (t['firms'], state['firms'], t['rows'], state['rows'], done * 100, t['rows'] / elapsed, t['windows'],
+           t['min_obs'], t['nan'], t['count'], t['anchor'], elapsed, left))
+    sys.stdout.flush()
+
+
+def say(message):
+    """
+
+    :param message: what the run is doing, e.g. the file it reads; printed unless quiet
+    """
+    if level != 'quiet':
+        print(message)
+
+
+def note(message):
+    """
+
+    :param message: detail of the run, printed in verbose mode only
+    """
+    if level == 'verbose':
+        print(message)
+
+
+def each_result(it, n, state):
+    """
+
+    :param it: iterator of pool.imap_unordered
+    :param n: number of results
+    :param state: result of start_progress
+    :return: generator of the results, printing the progress line while waiting for them
+    """
+    for i in range(n):
+        while True:
+            try:
+                result = it.next(timeout=max(interval, 0.5))
+                break
+            except mp.TimeoutError:
+                tick(state)
+        yield result
+        tick(state)
+
+
+def summary(state):
+    """
+
+    :param state: result of start_progress
+    :return: dict of the totals, throughput and time of the run, printed as one line of JSON
+    """
+    t, elapsed = totals(state), time.time() - state['t0']
+    out = {'firms': int(t['firms']), 'rows': int(t['rows']), 'windows': int(t['windows']),
+           'skipped': {rule: int(t[rule]) for rule in ['min_obs', 'nan', 'count', 'anchor']},
+           'values': int(t['values']), 'seconds': round(elapsed, 3), 'worker_seconds': round(t['seconds'], 3),
+           'rows_per_second': round(t['rows'] / elapsed, 1) if elapsed > 0 else None}
+    print(json.dumps(out))
+    return out
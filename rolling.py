@@ -0,0 +1,974 @@
+import os
+import re
+import json
+import time
+import hashlib
+import pandas as pd
+import numpy as np
+import heapq
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from progress import *
+
+#######################################################################################################################
+#                                              Rolling window engine                                                  #
+#######################################################################################################################
+# The daily scripts used to rebuild every window with a boolean mask over the whole partition, which is quadratic in
+# the partition size. Here we sort the partition once by permno and date, find the [start, end) row offsets of every
+# firm, and hand each characteristic contiguous numpy slices, so the cost is linear in the number of rows.
+
+
+def firm_offsets(permno):
+    """
+
+    :param permno: numpy array of permno, sorted by permno and date
+    :return: permno of every firm, start offset and end offset (exclusive) of every firm
+    """
+    permno = np.asarray(permno)
+    if len(permno) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return permno[:0], empty, empty
+    start = np.flatnonzero(np.r_[True, permno[1:] != permno[:-1]])
+    end = np.r_[start[1:], len(permno)]
+    return permno[start], start, end
+
+
+def sort_firms(df):
+    """
+
+    :param df: stock dataframe
+    :return: dataframe sorted by permno and date; one pass over the rows if it already is, e.g. read from the CSR layout
+    """
+    permno = df['permno'].to_numpy()
+    date = df['date'].to_numpy()
+    if ((permno[1:] > permno[:-1]) | ((permno[1:] == permno[:-1]) & (date[1:] >= date[:-1]))).all():
+        return df
+    return df.sort_values(by=['permno', 'date'])
+
+
+def firm_arrays(df, cols):
+    """
+
+    :param df: stock dataframe
+    :param cols: columns we need as numpy arrays
+    :return: dataframe sorted by permno and date, dict of float64 arrays, firm permno, start and end offsets
+    """
+    df = sort_firms(df).reset_index(drop=True)
+    arrays = {c: df[c].to_numpy(dtype=np.float64) for c in cols}
+    firm, start, end = firm_offsets(df['permno'].to_numpy())
+    return df, arrays, firm, start, end
+
+
+def rolling_sum(x, window):
+    """
+
+    :param x: numpy array of one firm, rolling along the first axis
+    :param window: rolling window
+    :return: sum of the last window rows at every row, i.e. yesterday's sum plus the new day minus the expired day
+    """
+    out = np.cumsum(x, axis=0)
+    out[window:] = out[window:] - out[:-window]
+    return out
+
+
+def rolling_moments(x, window, ddof=1, inf_as_nan=False):
+    """
+    Rolling count, mean, variance and standard deviation in one pass. Missing values are skipped like pandas. The
+    prefix sums run on x minus its firm mean, the shift the variance does not depend on, which keeps the sum of
+    squares small and avoids the cancellation of the textbook formula on series with a large mean (log dollar volume).
+
+    :param x: numpy array (n,) of one firm, or (n, m) of a panel of m firms
+    :param window: rolling window
+    :param ddof: delta degrees of freedom, 1 as pandas
+    :param inf_as_nan: True treats +-inf as missing, False gives a window with +-inf the mean of pandas (+-inf, or NaN
+                       with both signs) and NaN var/std
+    :return: dict of numpy arrays of the shape of x, count, mean, var and std
+    """
+    x = np.asarray(x, dtype=np.float64)
+    valid = np.isfinite(x) if inf_as_nan else ~np.isnan(x)
+    n_pinf = rolling_sum((np.isposinf(x) & valid).astype(np.int64), window)
+    n_ninf = rolling_sum((np.isneginf(x) & valid).astype(np.int64), window)
+    n_inf = n_pinf + n_ninf
+    finite = valid & np.isfinite(x)
+    shift = np.where(finite, x, 0.0).sum(axis=0) / np.maximum(finite.sum(axis=0), 1)
+    d = np.where(finite, x - shift, 0.0)
+    count = rolling_sum(valid.astype(np.int64), window)
+    s1 = rolling_sum(d, window)
+    s2 = rolling_sum(d * d, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, s1 / count + shift, np.nan)
+        var = np.maximum(s2 - s1 * s1 / count, 0) / (count - ddof)
+    # the shift by the firm mean leaves a rounding residue in windows far from it: a window of one repeated value (a
+    # stretch of zero turnover) gets exactly 0 as pandas, and the few windows whose sum of squares around their own
+    # mean is below 1e-4 of the shifted one, which would keep less than 12 digits, are computed directly
+    hi, lo = rolling_extrema(np.where(finite, x, np.nan), window)
+    var = np.where(hi == lo, 0.0, var)
+    redo = (count > ddof) & (n_inf == 0) & (hi != lo) & (var * (count - ddof) < 1e-4 * s2)
+    for i, *j in zip(*np.nonzero(redo)):
+        v = x[(slice(max(i - window + 1, 0), i + 1),) + tuple(j)]
+        var[(i,) + tuple(j)] = np.var(v[finite[(slice(max(i - window + 1, 0), i + 1),) + tuple(j)]], ddof=ddof)
+    var = np.where((count > ddof) & (n_inf == 0), var, np.nan)
+    mean = np.where(n_inf == 0, mean, np.where(n_ninf == 0, np.inf, np.where(n_pinf == 0, -np.inf, np.nan)))
+    return {'count': count, 'mean': mean, 'var': var, 'std': np.sqrt(var)}
+
+
+def rolling_momentum(ret, window, skip=0, compound=False):
+    """
+    Momentum from per-firm cumulative sums, so every window is one subtraction.
+
+    :param ret: numpy array (n,) of daily return of one firm, or (n, m) of a panel
+    :param window: rolling window, e.g. 250 means day t-249 to day t
+    :param skip: the most recent days left out, e.g. skip=21 means day t-249 to day t-21; 0 <= skip < window
+    :param compound: False for the sum of daily returns, True for the compounded return exp(sum log(1+r)) - 1
+    :return: numpy array of momentum, the shape of ret; NaN on the first skip rows, which have no formation day
+    """
+    if not 0 <= skip < window:
+        raise ValueError('skip must be at least 0 and less than the window, got skip %s for window %s' % (skip, window))
+    ret = np.asarray(ret, dtype=np.float64)
+    end = np.arange(1, len(ret) + 1) - skip  # window is row [end - (window - skip), end)
+    # the first skip rows of a firm have no formation day
+    empty = (end <= 0).reshape((-1,) + (1,) * (ret.ndim - 1))
+
+    def window_sum(x):
+        c = np.cumsum(x, axis=0)
+        c = np.concatenate([np.zeros((1,) + c.shape[1:]), c])
+        return c[np.maximum(end, 0)] - c[np.maximum(end - window + skip, 0)]
+
+    if not compound:
+        return np.where(empty, np.nan, window_sum(np.nan_to_num(ret)))
+    # a -100% day has log(1 + r) = -inf, which would poison every later window of the cumulative sum; those days are
+    # counted apart and their windows compound to -1
+    wiped = ret <= -1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(wiped | np.isnan(ret), 0.0, np.log1p(np.where(wiped, 0.0, ret)))
+    return np.where(empty, np.nan, np.where(window_sum(wiped.astype(np.int64)) > 0, -1.0, np.expm1(window_sum(x))))
+
+
+def rolling_extrema(x, window):
+    """
+    Rolling maximum and minimum in O(1) per row (van Herk / Gil-Werman). The series is cut into blocks of window rows;
+    every window spans at most two blocks, so its extremum is the suffix extremum of the first block combined with the
+    prefix extremum of the second. Missing values are skipped like pandas max/min.
+
+    :param x: numpy array (n,) of one firm, or (n, m) of a panel
+    :param window: rolling window, e.g. 20 for the MAX of Bali, Cakici and Whitelaw (2011)
+    :return: rolling maximum and rolling minimum, numpy arrays of the shape of x
+    """
+    n = len(x)
+    rest = np.shape(x)[1:]
+    j = np.arange(window - 1, window - 1 + n)  # padded position of the last day of every window
+    size = -(-(n + window - 1) // window) * window
+    result = []
+    for op, fill in [(np.maximum, -np.inf), (np.minimum, np.inf)]:
+        # pad window - 1 rows in front so the first days get (shorter) windows too
+        a = np.full((size,) + rest, fill)
+        a[window - 1:window - 1 + n] = np.where(np.isnan(x), fill, x)
+        b = a.reshape((-1, window) + rest)
+        prefix = op.accumulate(b, axis=1).reshape((size,) + rest)
+        suffix = op.accumulate(b[:, ::-1], axis=1)[:, ::-1].reshape((size,) + rest)
+        extremum = op(suffix[j - window + 1], prefix[j])
+        result.append(np.where(extremum == fill, np.nan, extremum))  # window with no observation
+    return result[0], result[1]
+
+
+def as_list(cols):
+    """
+
+    :param cols: None, a column or a list of columns
+    :return: list of columns
+    """
+    if cols is None:
+        return []
+    return [cols] if isinstance(cols, str) else list(cols)
+
+
+def lagged_sum(x, window, skip=0):
+    """
+
+    :param x: numpy array of one firm, rolling along the first axis
+    :param window: rolling window
+    :param skip: the most recent rows left out
+    :return: sum of the rows t-window+1 to t-skip at every row t, 0 on the first skip rows
+    """
+    sums = rolling_sum(x, window - skip)
+    out = np.zeros_like(sums)
+    out[skip:] = sums[:max(len(x) - skip, 0)]
+    return out
+
+
+def valid_rows(count_valid, nan_flag, window, min_obs, min_count=None, present=None, counters=None, counted=None,
+               skip=0):
+    """
+    The window rules as rolling counts over prefix sums of boolean masks, one eligibility vector for the whole firm.
+
+    :param count_valid: boolean numpy array, the count column is not missing, with a last axis of the count columns
+    :param nan_flag: boolean numpy array (n,), any of the NaN columns is missing; (n, m) on a panel
+    :param window: rolling window
+    :param min_obs: minimum rows in a window
+    :param min_count: minimum non-missing observations of every count column in a window, min_obs by default
+    :param present: boolean numpy array (n, m), the firm has this row of a panel; None for the rows of a firm
+    :param counters: row of counters of progress.py, the windows skipped by every rule are added to it
+    :param counted: boolean numpy array, the rows counted in counters; present (or every row of a firm) by default
+    :param skip: the most recent rows left out of the window, the rules count the rows t-window+1 to t-skip only
+    :return: boolean numpy array, the window ending at this row is eligible
+    """
+    min_count = min_obs if min_count is None else min_count
+    if present is None:
+        n_obs = np.clip(np.arange(1, len(nan_flag) + 1) - skip, 0, window - skip)
+    else:
+        n_obs = lagged_sum(present.astype(np.int64), window, skip)
+    enough = n_obs >= min_obs
+    no_nan = lagged_sum(nan_flag.astype(np.int64), window, skip) == 0
+    rows = enough & no_nan
+    if count_valid.size:
+        n_valid = lagged_sum(count_valid.astype(np.int64), window, skip)
+        rows = rows & (n_valid >= min_count).all(axis=-1)
+    if present is not None:
+        rows = rows & present
+    if counters is not None:
+        on = counted if counted is not None else np.ones(rows.shape, dtype=bool) if present is None else present
+        counters[field['min_obs']] += np.count_nonzero(on & ~enough)
+        counters[field['nan']] += np.count_nonzero(on & enough & ~no_nan)
+        counters[field['count']] += np.count_nonzero(on & enough & no_nan & ~rows)
+    return rows
+
+
+def spec_flags(arrays, idx, spec):
+    """
+
+    :param arrays: dict of float64 arrays
+    :param idx: rows of one firm the spec keeps
+    :param spec: characteristic spec, with count_col and nan_col (a column, a list or None)
+    :return: count_valid and nan_flag of valid_rows over idx, shared by every window of the spec
+    """
+    count_valid = np.column_stack([~np.isnan(arrays[c][idx]) for c in as_list(spec['count_col'])] +
+                                  [np.zeros((len(idx), 0), dtype=bool)])
+    nan_flag = np.zeros(len(idx), dtype=bool)
+    for c in as_list(spec['nan_col']):
+        nan_flag |= np.isnan(arrays[c][idx])
+    return count_valid, nan_flag
+
+
+def rolling_ols(y, X, window, rows, backend='stream', calendar=None):
+    """
+    Rolling OLS with an intercept from running sufficient statistics (n, sum x, sum y, sum xx', sum xy, sum y^2).
+    Each day adds the new observation and removes the expired one, so beta, residual variance and R2 cost O(k^2) per
+    day instead of the O(w^2) centering matrix M = I - 11'/n. The running sums drift slowly with the length of the
+    history; against the centering matrix solution the relative error is about 1e-11 per 5000 days, so within 1e-9 for
+    a firm listed since 1959.
+
+    :param y: numpy array (n,) of dependent variable of one firm, or (n, m) of a panel
+    :param X: numpy array (n, k) of regressors of one firm, or (n, m, k) of a panel
+    :param window: rolling window
+    :param rows: boolean numpy array of the shape of y, windows to be solved; days with a missing value are left out
+    :param backend: 'stream' for running sums, 'batch' for rolling_ols_batch (one firm only, a panel runs the sums)
+    :param calendar: optional calendar of factor_calendar for X, with pos, the calendar day of every row of the firm
+    :return: dict of numpy arrays, beta (n, k), rvar (n,) with ddof=1 as the original scripts, r2 (n,); on a panel
+             beta (n, m, k), rvar and r2 (n, m)
+    """
+    if backend == 'batch' and np.ndim(y) == 1:
+        return rolling_ols_batch(y, X, window, rows)
+    y = np.asarray(y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64).reshape(y.shape + (-1,))
+    k = X.shape[-1]
+    present = ~np.isnan(y) & ~np.isnan(X).any(axis=-1)
+    m = np.maximum(present.sum(axis=0), 1)
+    sums = None if calendar is None else calendar_sums(calendar, window, rows)
+    if sums is None:
+        # centered moments are shift invariant, so demean by firm to keep the running sums small
+        X = np.where(present[..., None], X - np.where(present[..., None], X, 0).sum(axis=0) / m[..., None], 0)
+        n = rolling_sum(present.astype(np.float64), window)[rows]
+        sx = rolling_sum(X, window)[rows]
+        sxx = rolling_sum(X[..., :, None] * X[..., None, :], window)[rows]
+    else:
+        # the regressors are the same on a day for every firm, their sums come from the calendar
+        X = np.nan_to_num(X - calendar['center'])
+        n, sx, sxx = sums
+    y = np.where(present, y - np.where(present, y, 0).sum(axis=0) / m, 0)
+    sy = rolling_sum(y, window)[rows]
+    sxy = rolling_sum(X * y[..., None], window)[rows]
+    syy = rolling_sum(y * y, window)[rows]
+    cxx = sxx - sx[:, :, None] * sx[:, None, :] / n[:, None, None]
+    cxy = sxy - sx * sy[:, None] / n[:, None]
+    cyy = syy - sy * sy / n
+    beta = np.linalg.solve(cxx, cxy[:, :, None])[:, :, 0]
+    rss = np.maximum(cyy - (beta * cxy).sum(axis=1), 0)
+    out = {'beta': np.full(y.shape + (k,), np.nan), 'rvar': np.full(y.shape, np.nan), 'r2': np.full(y.shape, np.nan)}
+    out['beta'][rows] = beta
+    out['rvar'][rows] = rss / (n - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['r2'][rows] = 1 - rss / cyy
+    return out
+
+
+def factor_calendar(day, X):
+    """
+    Prefix sums of the factors over the trading calendar. The factors are the same series for every firm, so their
+    window sums are looked up by the calendar days of the window instead of being summed again by every firm.
+
+    :param day: int numpy array (n,), calendar day of every row, 0 to T - 1
+    :param X: numpy array (n, k) of the factors of every row
+    :return: dict of center (k,), sf (T + 1, k) prefix sums of the centered factors, sff (T + 1, k, k) of their
+             outer products and bad (T + 1,) of the days with a missing factor
+    """
+    X = X if X.ndim == 2 else X[:, None]
+    # the first non-missing value of every day; firms share it
+    T = day.max() + 1 if len(day) else 0
+    f = pd.DataFrame(X).groupby(day).first().reindex(np.arange(T)).to_numpy()
+    # a day is bad if a factor is missing, or if some firm has another value than the others
+    differ = ((X != f[day]) & ~np.isnan(X)).any(axis=1)
+    bad = np.isnan(f).any(axis=1) | (np.bincount(day, weights=differ, minlength=T) > 0)
+    center = np.nanmean(f, axis=0) if (~bad).any() else np.zeros(f.shape[1])
+    f = np.nan_to_num(f - center)
+    k = f.shape[1]
+    return {'center': center,
+            'sf': np.vstack([np.zeros((1, k)), np.cumsum(f, axis=0)]),
+            'sff': np.concatenate([np.zeros((1, k, k)), np.cumsum(f[:, :, None] * f[:, None, :], axis=0)]),
+            'bad': np.r_[0, np.cumsum(bad)].astype(np.float64)}
+
+
+def calendar_sums(calendar, window, rows):
+    """
+
+    :param calendar: factor_calendar with pos, the calendar day of every row of one firm, or of a panel of firms with
+                     NaN before the first and after the last day of every firm
+    :param window: rolling window
+    :param rows: boolean numpy array of the shape of pos, windows to be solved
+    :return: n, sum x and sum xx' of the windows in rows, None if a window misses a calendar day or a factor
+    """
+    pos = calendar['pos']
+    i, *j = np.nonzero(rows)
+    j = tuple(j)
+    # on a panel every firm is a run of rows from its first day
+    lo = np.maximum(i - window + 1, np.argmax(~np.isnan(pos), axis=0)[j])
+    a = pos[(lo,) + j].astype(np.int64)
+    b = pos[(i,) + j].astype(np.int64) + 1
+    if (b - a != i - lo + 1).any() or (calendar['bad'][b] > calendar['bad'][a]).any():
+        return None
+    n = (i - lo + 1).astype(np.float64)
+    return n, calendar['sf'][b] - calendar['sf'][a], calendar['sff'][b] - calendar['sff'][a]
+
+
+def rolling_ols_batch(y, X, window, rows):
+    """
+    Rolling OLS with an intercept solving all windows of a firm at once. Every window is a view from
+    sliding_window_view, and the (n_windows, k+1, k+1) normal equations go through one np.linalg.solve call, so the
+    per-day loop becomes a handful of BLAS/LAPACK calls. It shares nothing with the running sums of rolling_ols and is
+    used to cross-check it.
+
+    :param y: numpy array (n,) of dependent variable of one firm
+    :param X: numpy array (n, k) of regressors of one firm
+    :param window: rolling window
+    :param rows: boolean numpy array (n,), windows to be solved, they should contain no missing value
+    :return: dict of numpy arrays, beta (n, k), rvar (n,) with ddof=1 as the original scripts, r2 (n,)
+    """
+    X = X.reshape(len(y), -1)
+    k = X.shape[1]
+    # pad window - 1 zero rows in front so the first days get (shorter) windows too; the intercept column is 0 on the
+    # padding, so padded rows drop out of the normal equations
+    pad = np.zeros((window - 1, k + 1))
+    Z = np.vstack([pad, np.column_stack([np.ones(len(y)), np.nan_to_num(X)])])
+    Y = np.r_[np.zeros(window - 1), np.nan_to_num(y)]
+    Zw = np.lib.stride_tricks.sliding_window_view(Z, window, axis=0)[rows]  # (n_windows, k+1, window)
+    Yw = np.lib.stride_tricks.sliding_window_view(Y, window)[rows]  # (n_windows, window)
+    ztz = np.einsum('nit,njt->nij', Zw, Zw)
+    zty = np.einsum('nit,nt->ni', Zw, Yw)
+    coef = np.linalg.solve(ztz, zty[:, :, None])[:, :, 0]
+    resid = Yw - np.einsum('nit,ni->nt', Zw, coef)
+    n = ztz[:, 0, 0]
+    rss = (resid * Zw[:, 0, :] * resid).sum(axis=1)
+    tss = (Yw * Yw).sum(axis=1) - zty[:, 0] * zty[:, 0] / n
+    out = {'beta': np.full((len(y), k), np.nan), 'rvar': np.full(len(y), np.nan), 'r2': np.full(len(y), np.nan)}
+    out['beta'][rows] = coef[:, 1:]
+    out['rvar'][rows] = rss / (n - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['r2'][rows] = 1 - rss / tss
+    return out
+
+
+def rolling_fused(df, specs):
+    """
+    Walk the history of every firm once and compute several characteristics on it. Each spec may keep only the rows
+    where its required columns are not missing, which is the sample its own query and dropna would give.
+
+    :param df: stock dataframe
+    :param specs: list of dict with keys func (function taking a dict of firm arrays keyed by cols, window and eligible
+                  rows, and returning a dict of output name to numpy array over the rows of the firm), cols, window,
+                  min_obs (if observations in a window are less than min_obs, we drop the characteristic of this day),
+                  count_col (column, list or None, whose non-missing observations must reach min_obs), nan_col
+                  (column, list or None, which must have no missing value in the window), columns (dict of func
+                  output name to dataframe column), and optional required (list of columns), min_count
+                  (minimum non-missing observations of the count columns, min_obs by default), windows (list of
+                  (window, min_obs) computed in the same pass, see spec_windows), skip (the most recent rows left
+                  out of every window, the rules count the rows t-window+1 to t-skip and func gets skip), freq
+                  (output frequency of anchor_rows, applied to the rows the spec keeps: only these anchor rows are
+                  evaluated, the window still reaching back over every day), calendar (factor columns whose window
+                  sums come from factor_calendar, passed to func as calendar) and kwargs
+    :return: dataframe with the characteristics
+    """
+    df, arrays, keep, firm, start, end = fused_arrays(df, specs)
+    state = start_progress(new_counters(1), len(firm), len(df))
+    result = fused_firms(arrays, keep, specs, firm, start, end, state['counters'][0])
+    summary(state)
+    return scatter_results(df, specs, [result])
+
+
+def spec_windows(spec):
+    """
+
+    :param spec: characteristic spec
+    :return: list of (window, min_obs, column suffix); a spec with windows, a list of (window, min_obs), computes every
+             horizon in the same pass and writes e.g. rvar_ff3_60d and rvar_ff3_250d
+    """
+    if spec.get('windows') is None:
+        return [(spec['window'], spec['min_obs'], '')]
+    return [(window, min_obs, '_%sd' % window) for window, min_obs in spec['windows']]
+
+
+def spec_kwargs(spec):
+    """
+
+    :param spec: characteristic spec
+    :return: keyword arguments of func: kwargs of the spec, with skip when the spec leaves out the most recent days
+    """
+    if spec.get('skip'):
+        return dict(spec.get('kwargs', {}), skip=spec['skip'])
+    return spec.get('kwargs', {})
+
+
+def spec_columns(specs):
+    """
+
+    :param specs: list of characteristic specs
+    :return: list of the output columns of all specs
+    """
+    return [column + suffix for spec in specs for window, min_obs, suffix in spec_windows(spec)
+            for column in spec['columns'].values()]
+
+
+def fused_arrays(df, specs):
+    """
+
+    :param df: stock dataframe
+    :param specs: list of characteristic specs
+    :return: dataframe sorted by permno and date, dict of float64 arrays of the columns the specs need (and of the
+             factor calendars and anchor rows), list of the boolean array of rows every spec keeps (None keeps all),
+             firm permno, start and end offsets
+    """
+    need = []
+    for spec in specs:
+        need = need + list(spec['cols']) + as_list(spec['count_col']) + as_list(spec['nan_col'])
+        need = need + as_list(spec.get('calendar'))
+    need = list(dict.fromkeys(need))
+    keep = [None if spec.get('required') is None else df[spec['required']].notna().all(axis=1) for spec in specs]
+    df = df.assign(**{'_keep%s' % h: k for h, k in enumerate(keep) if k is not None})
+    df, arrays, firm, start, end = firm_arrays(df, need)
+    keep = [None if k is None else df.pop('_keep%s' % h).to_numpy() for h, k in enumerate(keep)]
+    if any(spec.get('calendar') is not None for spec in specs):
+        day = np.unique(df['date'].to_numpy(), return_inverse=True)[1].reshape(-1)
+        arrays['_day'] = day.astype(np.float64)
+    for h, spec in enumerate(specs):
+        if spec.get('calendar') is not None:
+            # rows a spec drops leave gaps, those firms fall back to their own sums
+            k = np.ones(len(df), dtype=bool) if keep[h] is None else keep[h]
+            X = np.column_stack([arrays[c][k] for c in spec['calendar']])
+            for name, value in factor_calendar(day[k], X).items():
+                arrays['_%s%s' % (name, h)] = value
+        if spec_anchor(spec) is not None:
+            # on the rows the spec keeps, a month end dropped by its required columns moves to the day before
+            k = np.arange(len(df)) if keep[h] is None else np.flatnonzero(keep[h])
+            anchor = np.zeros(len(df))
+            anchor[k] = anchor_rows(df['permno'].to_numpy()[k], df['date'].to_numpy()[k], spec['freq'])
+            arrays[spec_anchor(spec)] = anchor
+    return df, arrays, keep, firm, start, end
+
+
+def anchor_rows(permno, date, freq='daily'):
+    """
+
+    :param permno: numpy array of permno, sorted by permno and date
+    :param date: numpy datetime64 array of the dates
+    :param freq: 'daily', 'week' (last day of the firm in the week), 'month' (last day of the firm in the month, the
+                 closest trading day to the month end) or a list of dates
+    :return: boolean numpy array, the rows where the characteristics are evaluated
+    """
+    if isinstance(freq, str) and freq == 'daily':
+        return np.ones(len(date), dtype=bool)
+    if isinstance(freq, str) and freq in ['week', 'month']:
+        day = date.astype('datetime64[D]').astype(np.int64)
+        # 1970-01-01 is a Thursday, weeks start on Monday
+        period = (day + 3) // 7 if freq == 'week' else date.astype('datetime64[M]').astype(np.int64)
+        last = np.ones(len(date), dtype=bool)
+        last[:-1] = (permno[1:] != permno[:-1]) | (period[1:] != period[:-1])
+        return last
+    return np.isin(date.astype('datetime64[ns]'), np.asarray(pd.to_datetime(freq), dtype='datetime64[ns]'))
+
+
+def spec_anchor(spec):
+    """
+
+    :param spec: characteristic spec
+    :return: name of the array of its anchor rows made by fused_arrays, None when every row is evaluated
+    """
+    if spec.get('freq') is None or (isinstance(spec['freq'], str) and spec['freq'] == 'daily'):
+        return None
+    return '_anchor_' + spec_columns([spec])[0]
+
+
+def fused_firms(arrays, keep, specs, firm, start, end, counters=None):
+    """
+
+    :param arrays: dict of float64 arrays of the columns the specs need
+    :param keep: list of the boolean array of rows every spec keeps (None keeps all)
+    :param specs: list of characteristic specs
+    :param firm: permno of the firms to compute
+    :param start: start offsets of the firms
+    :param end: end offsets of the firms
+    :param counters: row of counters of progress.py the firms are added to, firm by firm
+    :return: dict of output column to (int64 row positions, float64 values), only the rows with a value
+    """
+    pos = {column: [] for column in spec_columns(specs)}
+    val = {column: [] for column in spec_columns(specs)}
+    counters = new_counters(1)[0] if counters is None else counters
+    for permno, s, e in zip(firm, start, end):
+        t0 = time.perf_counter()
+        for h, (spec, k) in enumerate(zip(specs, keep)):
+            idx = np.arange(s, e) if k is None else s + np.flatnonzero(k[s:e])
+            count_valid, nan_flag = spec_flags(arrays, idx, spec)
+            w = {c: arrays[c][idx] for c in spec['cols']}
+            kwargs = spec_kwargs(spec)
+            if spec.get('calendar') is not None:
+                calendar = {name: arrays['_%s%s' % (name, h)] for name in ['center', 'sf', 'sff', 'bad']}
+                kwargs = dict(kwargs, calendar=dict(calendar, pos=arrays['_day'][idx]))
+            for window, min_obs, suffix in spec_windows(spec):
+                rows = valid_rows(count_valid, nan_flag, window, min_obs, spec.get('min_count'), counters=counters,
+                                  skip=spec.get('skip', 0))
+                if spec_anchor(spec) is not None:
+                    anchor = arrays[spec_anchor(spec)][idx] > 0
+                    counters[field['anchor']] += np.count_nonzero(rows & ~anchor)
+                    rows = rows & anchor
+                if not rows.any():
+                    continue
+                counters[field['windows']] += np.count_nonzero(rows)
+                result = spec['func'](w, window, rows, **kwargs)
+                for name, value in result.items():
+                    # NaN of the kernel, e.g. a zero midpoint, is dropped with the rolling NaN afterwards anyway
+                    has = rows & ~np.isnan(value)
+                    pos[spec['columns'][name] + suffix].append(idx[has])
+                    val[spec['columns'][name] + suffix].append(value[has])
+                    counters[field['values']] += np.count_nonzero(has)
+        counters[field['seconds']] += time.perf_counter() - t0
+        counters[field['rows']] += e - s
+        counters[field['firms']] += 1
+    return {column: (np.concatenate(pos[column] + [np.empty(0, dtype=np.int64)]).astype(np.int64),
+                     np.concatenate(val[column] + [np.empty(0)]).astype(np.float64)) for column in pos}
+
+
+def scatter_results(df, specs, results):
+    """
+
+    :param df: stock dataframe of fused_arrays
+    :param specs: list of characteristic specs
+    :param results: list of results of fused_firms, one for every chunk of firms (or of a part of the specs)
+    :return: dataframe with the characteristics, NaN where a row has no value
+    """
+    columns = spec_columns(specs)
+    # one float64 buffer for all the characteristics, filled by row position and attached to df in one go
+    out = np.full((len(df), len(columns)), np.nan, dtype=np.float64)
+    for result in results:
+        for j, column in enumerate(columns):
+            if column in result:
+                out[result[column][0], j] = result[column][1]
+    df = df.drop(columns=[c for c in columns if c in df])
+    df = pd.concat([df, pd.DataFrame(out, columns=columns, index=df.index)], axis=1)
+    return df
+
+
+def rolling_panel(df, specs, memory=2 ** 23):
+    """
+    Compute the characteristics of all the firms at once. The firms are laid out side by side on a dense (rows x firms)
+    panel stored column-major, row t of a column being the t-th row of its firm, and the functions of the specs roll
+    down every column in the same numpy calls. A window is a number of rows of the firm as in rolling_fused, so the
+    panel needs no calendar alignment and no overlap between blocks: a block is a set of whole firms of about the same
+    length, as many as memory allows, and only the shorter firms of a block are padded.
+
+    :param df: stock dataframe
+    :param specs: list of characteristic specs, as rolling_fused
+    :param memory: bytes for the panel of a block, see panel_blocks
+    :return: dataframe sorted by permno and date with the characteristics
+    """
+    df, arrays, keep, firm, start, end = fused_arrays(df, specs)
+    firm_of = np.repeat(np.arange(len(firm)), end - start)
+    # every spec walks all the firms once
+    state = start_progress(new_counters(1), len(firm) * len(specs), len(df) * len(specs))
+    results = []
+    for h, (spec, k) in enumerate(zip(specs, keep)):
+        calendar = None if spec.get('calendar') is None else \
+            {name: arrays['_%s%s' % (name, h)] for name in ['center', 'sf', 'sff', 'bad']}
+        kept = np.arange(len(df)) if k is None else np.flatnonzero(k)
+        results.append(panel_spec(arrays, kept, firm_of[kept], spec, memory, state, calendar))
+        # the rows the spec drops and the firms without rows are done as well
+        state['counters'][0, field['firms']] += len(firm) - len(np.unique(firm_of[kept]))
+        state['counters'][0, field['rows']] += len(df) - len(kept)
+    summary(state)
+    return scatter_results(df, specs, results)
+
+
+# bytes of a block of the panel per firm and row: the columns of the spec and the temporaries of its function, about
+# 48 float64 arrays of the block at the peak of rvar_ff3
+panel_cell_bytes = 48 * 8
+
+
+def panel_blocks(length, gap, memory):
+    """
+    Pack the firms into blocks from the longest down. A block takes firms until its panel fills memory, or until a
+    firm is shorter than 0.9 of its first, so padding is at most a tenth of a block; the firms skipping a calendar day
+    are packed apart, so the others keep the sums of the calendar.
+
+    :param length: numpy array, rows of every firm
+    :param gap: boolean numpy array, the firm skips a calendar day
+    :param memory: bytes for the panel of a block; a firm longer than it gets a block of its own
+    :return: list of int numpy arrays, the firms of every block
+    """
+    order = np.lexsort((-length, gap))
+    length, gap = length[order], gap[order]
+    blocks = []
+    b0 = 0
+    while b0 < len(order):
+        stop = (length[b0:] < 0.9 * length[b0]) | (gap[b0:] != gap[b0])
+        stop = b0 + (np.argmax(stop) if stop.any() else len(stop))
+        stop = min(stop, b0 + max(int(memory // (panel_cell_bytes * length[b0])), 1))
+        blocks.append(order[b0:stop])
+        b0 = stop
+    return blocks
+
+
+def panel_spec(arrays, kept, firm_of, spec, memory=2 ** 23, state=None, calendar=None):
+    """
+
+    :param arrays: dict of float64 arrays
+    :param kept: rows the spec keeps, sorted by firm and date
+    :param firm_of: firm of the rows
+    :param spec: characteristic spec
+    :param memory: bytes for the panel of a block, see panel_blocks
+    :param state: result of start_progress of progress.py, the firms of every block are added to its counters
+    :param calendar: factor_calendar of the spec made by fused_arrays, None to sum the factors of every firm
+    :return: dict of output column to (int64 row positions, float64 values), as fused_firms
+    """
+    state = start_progress(new_counters(1), 0, len(kept)) if state is None else state
+    counters = state['counters'][0]
+    windows = spec_windows(spec)
+    count_cols = as_list(spec['count_col'])
+    cols = list(dict.fromkeys(list(spec['cols']) + count_cols + as_list(spec['nan_col']) +
+                              as_list(spec_anchor(spec))))
+    pos = {column + suffix: [] for window, min_obs, suffix in windows for column in spec['columns'].values()}
+    val = {column: [] for column in pos}
+    head = np.flatnonzero(np.r_[True, firm_of[1:] != firm_of[:-1]]) if len(kept) else np.zeros(0, dtype=np.int64)
+    length = np.diff(np.r_[head, len(kept)])
+    gap = np.zeros(len(head), dtype=bool)
+    if calendar is not None:
+        step = np.diff(arrays['_day'][kept]) != 1
+        step[head[1:] - 1] = False  # the first row of a firm
+        gap[np.searchsorted(head, np.flatnonzero(step), side='right') - 1] = True
+    blocks = panel_blocks(length, gap, memory)
+    for b, block in enumerate(blocks):
+        note('processing panel block %s of %s, %s firms of %s to %s rows' %
+             (b + 1, len(blocks), len(block), length[block].min(), length[block].max()))
+        t0 = time.perf_counter()
+        n = length[block]
+        shape = (len(block), n.max())
+        # the rows of the block firm by firm, and their place in a (firms, rows) array, the transpose of which is the
+        # column-major panel; with firms of one length it is the rows as they are
+        within = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        src = kept[np.repeat(head[block], n) + within]
+        dst = None if n.min() == shape[1] else np.repeat(np.arange(len(block)) * shape[1], n) + within
+
+        def lay(values, fill):
+            if dst is None:
+                return values.reshape(shape).T
+            out = np.full(shape[0] * shape[1], fill, dtype=values.dtype)
+            out[dst] = values
+            return out.reshape(shape).T
+
+        present = lay(np.ones(len(src), dtype=bool), False)
+        rowpos = lay(src, -1)
+        panel = {c: lay(arrays[c][src], np.nan) for c in cols}
+        valid = [~np.isnan(panel[c]) for c in count_cols]
+        count_valid = valid[0][..., None] if len(valid) == 1 else \
+            np.stack(valid + [np.zeros_like(present)], axis=-1)[..., :len(valid)]
+        nan_flag = np.zeros_like(present)
+        for c in as_list(spec['nan_col']):
+            nan_flag |= np.isnan(panel[c]) & present
+        w = {c: panel[c] for c in spec['cols']}
+        kwargs = spec_kwargs(spec)
+        if calendar is not None and not gap[block[0]]:
+            kwargs = dict(kwargs, calendar=dict(calendar, pos=lay(arrays['_day'][src], np.nan)))
+        for window, min_obs, suffix in windows:
+            rows = valid_rows(count_valid, nan_flag, window, min_obs, spec.get('min_count'), present=present,
+                              counters=counters, skip=spec.get('skip', 0))
+            if spec_anchor(spec) is not None:
+                anchor = panel[spec_anchor(spec)] > 0
+                counters[field['anchor']] += np.count_nonzero(rows & ~anchor)
+                rows = rows & anchor
+            if not rows.any():
+                continue
+            counters[field['windows']] += np.count_nonzero(rows)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = spec['func'](w, window, rows, **kwargs)
+            for name, value in result.items():
+                has = rows & ~np.isnan(value)
+                pos[spec['columns'][name] + suffix].append(rowpos[has])
+                val[spec['columns'][name] + suffix].append(value[has])
+                counters[field['values']] += np.count_nonzero(has)
+        counters[field['seconds']] += time.perf_counter() - t0
+        counters[field['rows']] += len(src)
+        counters[field['firms']] += len(block)
+        tick(state)
+    return {column: (np.concatenate(pos[column] + [np.empty(0, dtype=np.int64)]).astype(np.int64),
+                     np.concatenate(val[column] + [np.empty(0)]).astype(np.float64)) for column in pos}
+
+
+def balance_firms(firm_list, n):
+    """
+    Longest-processing-time-first bin packing: the work of a firm scales with its number of days, so firms are handed,
+    longest first, to the chunk with the fewest days so far, and every chunk ends up with about the same rows.
+
+    :param firm_list: list of firms with day_num (number of days - 1)
+    :param n: number of chunks
+    :return: list of n firm lists
+    """
+    cost = firm_list['day_num'].to_numpy() + 1
+    chunk = np.zeros(len(firm_list), dtype=np.int64)
+    heap = [(0, h) for h in range(n)]
+    for i in np.argsort(-cost, kind='stable'):
+        load, h = heapq.heappop(heap)
+        chunk[i] = h
+        heapq.heappush(heap, (load + cost[i], h))
+    return [firm_list[chunk == h] for h in range(n)]
+
+
+#######################################################################################################################
+#                                                Shared memory pool                                                   #
+#######################################################################################################################
+# Instead of pickling a sub dataframe into every worker, the columns are published once in shared memory. Workers only
+# get the offsets of their firms and send back the row positions and values of the rows with a characteristic.
+
+
+def share_arrays(arrays):
+    """
+
+    :param arrays: dict of numpy arrays
+    :return: list of SharedMemory, dict of numpy arrays on them, meta to attach them in another process
+    """
+    shms, views, meta = [], {}, {}
+    for name, a in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        views[name] = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+        views[name][...] = a
+        shms.append(shm)
+        meta[name] = (shm.name, a.shape, a.dtype.str)
+    return shms, views, meta
+
+
+def attach_arrays(meta):
+    """
+
+    :param meta: meta of share_arrays
+    :return: list of SharedMemory, dict of numpy arrays on them
+    """
+    shms, views = [], {}
+    for name, (shm_name, shape, dtype) in meta.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        views[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        shms.append(shm)
+    return shms, views
+
+
+def pool_chunk(task):
+    """
+
+    :param task: tuple of meta of share_arrays, specs, number of the chunk, permno, start and end offsets of its firms
+    :return: number of the chunk, result of fused_firms
+    """
+    meta, specs, part, firm, start, end = task
+    shms, views = attach_arrays(meta)
+    arrays = {k: v for k, v in views.items() if not k.startswith('_keep') and k != '_progress'}
+    keep = [views.get('_keep%s' % h) for h in range(len(specs))]
+    # the row of counters of this chunk, read by the parent while the chunk runs
+    result = fused_firms(arrays, keep, specs, firm, start, end, views['_progress'][part])
+    del arrays, keep, views
+    for shm in shms:
+        shm.close()
+    return part, result
+
+
+def rolling_pool(df, specs, n, checkpoint=None, part_rows=2000000):
+    """
+
+    :param df: stock dataframe
+    :param specs: list of characteristic specs, as rolling_fused
+    :param n: number of chunks of firms, balanced by their number of days
+    :param checkpoint: directory where every finished chunk is saved, a run that died resumes from it; None keeps the
+                       results in memory only
+    :param part_rows: with a checkpoint, chunks have at most about this many rows, so a dying run loses little work
+    :return: dataframe sorted by permno and date with the characteristics
+    """
+    df, arrays, keep, firm, start, end = fused_arrays(df, specs)
+    shared = dict(arrays)
+    shared.update({'_keep%s' % h: k for h, k in enumerate(keep) if k is not None})
+    del arrays, keep
+    # up to n cores, as before, whatever the number of chunks
+    processes = min(n, mp.cpu_count())
+    if checkpoint is not None:
+        n = max(n, -(-len(df) // part_rows))
+    firm_list = pd.DataFrame({'permno': firm, 'start': start, 'end': end, 'day_num': end - start - 1})
+    chunks = balance_firms(firm_list, n)
+    results, done = [], set()
+    if checkpoint is not None:
+        key = checkpoint_key(dict(shared, _date=df['date'].to_numpy()), specs, chunks)
+        done = read_checkpoint(checkpoint, key)
+        results = [load_part(checkpoint, h) for h in sorted(done)]
+        if done:
+            say('resuming from %s: %s of %s chunks done' % (checkpoint, len(done), n))
+    shared['_progress'] = new_counters(n)
+    for h in done:
+        shared['_progress'][h, field['firms']] = len(chunks[h])
+        shared['_progress'][h, field['rows']] = chunks[h]['day_num'].sum() + len(chunks[h])
+    shms, views, meta = share_arrays(shared)
+    state = start_progress(views['_progress'], len(firm), len(df))
+    del shared, views
+    try:
+        tasks = []
+        for h, chunk in enumerate(chunks):
+            if h in done:
+                continue
+            note('processing splitting dataframe: %s with %s rows' % (h, chunk['day_num'].sum() + len(chunk)))
+            tasks.append((meta, specs, h, chunk['permno'].to_numpy(), chunk['start'].to_numpy(),
+                          chunk['end'].to_numpy()))
+        # leaving the with block terminates the workers, also when a chunk raised, before the memory is unlinked
+        with mp.Pool(processes) as pool:
+            # chunks are handed out one at a time, so an idle core picks up the next one
+            for h, result in each_result(pool.imap_unordered(pool_chunk, tasks), len(tasks), state):
+                note('chunk %s done: %d firms, %d rows in %.1fs' % (h, len(chunks[h]),
+                                                                   state['counters'][h, field['rows']],
+                                                                   state['counters'][h, field['seconds']]))
+                if checkpoint is not None:
+                    done.add(h)
+                    save_part(checkpoint, key, h, result, done)
+                results.append(result)
+        summary(state)
+    finally:
+        # the counters live in shared memory, which is released here
+        state['counters'] = state['counters'].copy()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    note('processing scatter results')
+    return scatter_results(df, specs, results)
+
+
+#######################################################################################################################
+#                                                   Checkpoints                                                       #
+#######################################################################################################################
+# A checkpoint directory holds one part<h>.npz per finished chunk of rolling_pool, with the row positions and values of
+# every output column, and manifest.json with the chunks done. The chunks are only reused by a run with the same key:
+# the same columns, specs and chunks of firms, as row positions mean nothing on other data.
+
+
+def checkpoint_key(arrays, specs, chunks):
+    """
+
+    :param arrays: dict of numpy arrays shared with the workers, and the dates
+    :param specs: list of characteristic specs
+    :param chunks: list of firm lists of balance_firms
+    :return: sha256 of the data, specs and chunks of a run
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(specs, sort_keys=True, default=lambda v: getattr(v, '__name__', repr(v))).encode())
+    for name in sorted(arrays):
+        h.update(name.encode())
+        h.update(np.ascontiguousarray(arrays[name]).view(np.uint8))
+    for chunk in chunks:
+        for c in ['permno', 'start']:
+            h.update(np.ascontiguousarray(chunk[c].to_numpy(dtype=np.int64)).view(np.uint8))
+        h.update(b'|')
+    return h.hexdigest()
+
+
+def read_checkpoint(path, key):
+    """
+
+    :param path: checkpoint directory
+    :param key: result of checkpoint_key
+    :return: set of the chunks done; a checkpoint of another run is cleared
+    """
+    manifest = os.path.join(path, 'manifest.json')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            saved = json.load(f)
+        if saved['key'] == key:
+            return {h for h in saved['done'] if os.path.exists(os.path.join(path, 'part%s.npz' % h))}
+    elif os.path.isdir(path) and os.listdir(path):
+        raise ValueError('%s is not empty and has no manifest.json, it is not a checkpoint directory' % path)
+    clear_checkpoint(path)
+    os.makedirs(path, exist_ok=True)
+    with open(manifest, 'w') as f:
+        json.dump({'key': key, 'done': []}, f)
+    return set()
+
+
+def save_part(path, key, part, result, done):
+    """
+
+    :param path: checkpoint directory
+    :param key: result of checkpoint_key
+    :param part: number of the chunk
+    :param result: result of fused_firms of the chunk
+    :param done: set of the chunks done, with this one
+    """
+    arrays = {}
+    for j, (column, (pos, val)) in enumerate(result.items()):
+        arrays.update({'column%s' % j: np.array(column), 'pos%s' % j: pos, 'val%s' % j: val})
+    # written under another name and renamed, a chunk is either complete or missing
+    with open(os.path.join(path, 'part%s.tmp' % part), 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(os.path.join(path, 'part%s.tmp' % part), os.path.join(path, 'part%s.npz' % part))
+    with open(os.path.join(path, 'manifest.tmp'), 'w') as f:
+        json.dump({'key': key, 'done': sorted(done)}, f)
+    os.replace(os.path.join(path, 'manifest.tmp'), os.path.join(path, 'manifest.json'))
+
+
+def load_part(path, part):
+    """
+
+    :param path: checkpoint directory
+    :param part: number of the chunk
+    :return: result of fused_firms of the chunk
+    """
+    with np.load(os.path.join(path, 'part%s.npz' % part)) as a:
+        return {str(a['column%s' % j]): (a['pos%s' % j], a['val%s' % j]) for j in range(len(a.files) // 3)}
+
+
+def checkpoint_files(path):
+    """
+
+    :param path: checkpoint directory
+    :return: names of the files of the checkpoint in it, any other file is left alone
+    """
+    if not os.path.isdir(path):
+        return []
+    return [name for name in os.listdir(path) if re.fullmatch(r'part\d+\.(npz|tmp)|manifest\.(json|tmp)', name)]
+
+
+def clear_checkpoint(path):
+    """
+
+    :param path: checkpoint directory, None does nothing
+    """
+    if path is None:
+        return
+    for name in checkpoint_files(path):
+        os.remove(os.path.join(path, name))
+    # the directory goes only when nothing else is in it
+    if os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)